@@ -1,17 +1,24 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import sys
-import copy
 from scipy.io import wavfile
-from scipy.signal import butter, lfilter
+from scipy.fft import rfft
+from scipy.signal import butter, sosfilt, firwin, fftconvolve
 import scipy.signal as sps
-import scipy.ndimage
 import audioop
 import logging
-import os
-import shutil
-import wave
 import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# threads per fft, all cores by default. process_batch workers use 1
+_FFT_WORKERS = -1
+
+try:
+    import torch
+except ImportError:
+    torch = None
 
 # logging configuration
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -29,7 +36,7 @@ class DataProcessor(object):
     def __init__(self, filepath, lowcut=500, highcut=15000,
                  fft_size=2048, spec_thresh=4, n_freq_components=64,
                  shorten_factor=10, start_freq=300,
-                 end_freq=8000, samplerate=16000, logger=None):
+                 end_freq=8000, samplerate=16000, logger=None, device=None):
         """
         Args:
             # Required #
@@ -44,6 +51,8 @@ class DataProcessor(object):
             start_freq (int) : Frequency to start sampling our melS from
             end_freq (int) : Frequency to stop sampling our melS from
             logger : python logger - defaults to __name__ level logger.
+            device (str) : torch device, e.g. 'cuda', to compute spectrograms
+                           on - defaults to None, computing them with numpy
         """
         self.filepath = filepath
         self.lowcut = lowcut
@@ -57,6 +66,14 @@ class DataProcessor(object):
         self.end_freq = end_freq
         self.samplerate = samplerate
         self.logger = logger or logging.getLogger(__name__)
+        self.device = device
+        # lazily computed, only depend on the parameters above
+        self._hamming_windows = {}
+        self._bandpass_taps = {}
+        self._mel_filters = None
+        self._frames_buffer = None
+        self._data = None
+        self._spectrogram = None
 
     def __getitem__(self, index):
         return self.data[index]
@@ -73,6 +90,17 @@ class DataProcessor(object):
         """
         return self.filepath == other.filepath
 
+    @property
+    def data(self):
+        """raw audio samples, setting them drops the cached spectrogram
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._spectrogram = None
+
     @property
     def dimensions(self):
         """dimensions of array
@@ -84,49 +112,47 @@ class DataProcessor(object):
     #  loading and augmentation   #
     ###############################
 
-    def _downsample(self, out_rate):
-        """ Downsamples data at self.filepath to have rate, `outrate`
-        and writes data to to file with new downsampled rate. Neccesary
-        for dimensionality/complexity reduction in classification
+    def _downsample(self, data, in_rate, out_rate):
+        """ Downsamples data from rate `in_rate` to rate `out_rate` with a
+        polyphase filter. Neccesary for dimensionality/complexity reduction
+        in classification
         Args:
+            data (np.array) : wav file data, samples along the first axis
+            in_rate (int) : the rate of data
             out_rate (int) : the desired downsampled rate
+        Returns:
+            (np.array) float32 data at out_rate
         """
-        temp_filepath = self.filepath.rstrip('.wav')+'_downsample_'+str(out_rate)+'.wav'
-
-        in_wav = wave.open(self.filepath)
-        self.logger.info('original rate is : %s', in_wav.getframerate())
-
-        out_wav = wave.open(temp_filepath, "w")
-        out_wav.setframerate(out_rate)
-        out_wav.setnchannels(in_wav.getnchannels())
-        out_wav.setsampwidth(in_wav.getsampwidth())
-        out_wav.setnframes(1)
-
-        if in_wav.getsampwidth() == 1:
-            nptype = np.uint8
-        elif in_wav.getsampwidth() == 2:
-            nptype = np.uint16
-
-        in_rate = in_wav.getframerate()
-        in_nframes = in_wav.getnframes()
-
-        audio = in_wav.readframes(in_nframes)
-        nroutsamples = round(len(audio) * out_rate/in_rate)
-
-        audio_out = sps.resample(np.fromstring(audio, nptype), nroutsamples)
-        audio_out = audio_out.astype(nptype)
-
-        out_wav.writeframes(audio_out.copy(order='C'))
-
-        self.logger.info('written {} with rate {}'.format(temp_filepath, out_rate))
-        out_wav.close()
-
-        shutil.copy(temp_filepath, self.filepath)
-
-        self.logger.info('removing tempfile: {}'.format(temp_filepath))
-        os.remove(temp_filepath)
+        if in_rate == out_rate:
+            return data.astype(np.float32, copy=False)
+        self.logger.info('downsampling from {} to {}'.format(in_rate, out_rate))
+        return sps.resample_poly(data, out_rate, in_rate,
+                                 axis=0).astype(np.float32)
+
+    def _to_mono(self, data):
+        """ Averages multi-channel wav data down to a single channel
+        Args:
+            data (np.array) : wav file data, shape (n_samples,) or
+                              (n_samples, n_channels)
+        Returns:
+            (np.array) data with shape (n_samples,)
+        """
+        if data.ndim == 1:
+            return data
+        return data.mean(axis=1, dtype=np.float32)
 
-        return out_rate
+    def _read_wav(self):
+        """ Reads the wav at self.filepath, memory mapped where scipy
+        supports it so only the sampled window is read from disk
+        Returns:
+            rate (int), data (np.array or np.memmap)
+        """
+        try:
+            return wavfile.read(self.filepath, mmap=True)
+        except ValueError:
+            # e.g. 24-bit files, which scipy cannot memory map
+            self.logger.info('cannot mmap {}, reading it whole'.format(self.filepath))
+            return wavfile.read(self.filepath)
 
     def load_data(self, n_secs, req_buffer=5):
         """Loads a n_sec sample of the file
@@ -136,11 +162,14 @@ class DataProcessor(object):
         Returns:
             None
         """
-        self.rate, data = wavfile.read(self.filepath)
+        self.rate, data = self._read_wav()
         buffer_zone = self.rate*(n_secs+req_buffer)
         random_start = random.randint(buffer_zone, len(data)-buffer_zone)
         self.logger.info('random_start is {}'.format(random_start))
-        data = data[random_start: random_start+self.rate*n_secs]
+        # copy the window out of the memory map as float32 in one pass
+        data = np.array(data[random_start: random_start+self.rate*n_secs],
+                        dtype=np.float32)
+        data = self._to_mono(data)
         self.logger.info('data is {}'.format(data))
         self.data = data
 
@@ -156,16 +185,19 @@ class DataProcessor(object):
         Returns:
             None
         """
-        new_rate = self._downsample(rate)
-        self.logger.info('downsampling {} to {}'.format(self.filepath, new_rate))
-        self.rate, data = wavfile.read(self.filepath)
-        self.logger.info('rate read as: {}'.format(self.rate))
+        in_rate, data = self._read_wav()
+        self.logger.info('rate read as: {}'.format(in_rate))
         self.logger.info('len data is {}'.format(len(data)))
         # should not be too close to start/end of song
-        buffer_zone = self.rate*(n_secs+req_buffer)
+        buffer_zone = in_rate*(n_secs+req_buffer)
         random_start = random.randint(buffer_zone, len(data)-buffer_zone)
         self.logger.info('random_start is {}'.format(random_start))
-        data = data[random_start: random_start + self.rate*n_secs]
+        # only the sample itself is resampled, not the whole track
+        data = np.array(data[random_start: random_start + in_rate*n_secs],
+                        dtype=np.float32)
+        data = self._to_mono(data)
+        self.rate = rate
+        data = self._downsample(data, in_rate, rate)
         self.logger.info('data is {}'.format(data))
         self.data = data
 
@@ -214,11 +246,30 @@ class DataProcessor(object):
         nyqist_freq = 0.5 * rate
         low = self.lowcut / nyqist_freq
         high = self.highcut / nyqist_freq
-        b, a = butter(order, [low, high], btype='band')
+        # second order sections are numerically stable at higher orders
+        # and run the recurrence in compiled code
+        sos = butter(order, [low, high], btype='band', output='sos')
 
-        y = lfilter(b, a, data)
+        y = sosfilt(sos, data)
         return y
 
+    def fir_bandpass_filter(self, data, rate, numtaps=129):
+        """ Linear phase FIR band pass filter between lowcut and highcut,
+        applied by FFT convolution. Taps are cached per rate
+        Args:
+            data (np.array) : wav file data
+            rate (float) : rate of the data
+            numtaps (int) : length of the filter
+        Returns
+            (np.array) band pass filtered data, same length as data
+        """
+        key = (rate, numtaps)
+        if key not in self._bandpass_taps:
+            self._bandpass_taps[key] = firwin(numtaps,
+                                              [self.lowcut, self.highcut],
+                                              pass_zero=False, fs=rate)
+        return fftconvolve(data, self._bandpass_taps[key], mode='same')
+
     def overlap(self, X, window_size, window_step):
         """
         Create an overlapped version of X
@@ -232,7 +283,7 @@ class DataProcessor(object):
         if window_size % 2 != 0:
             raise ValueError("Window size must be even!")
         # Make sure there are an even number of windows before stridetricks
-        append = np.zeros((window_size - len(X) % window_size))
+        append = np.zeros((window_size - len(X) % window_size), dtype=X.dtype)
         X = np.hstack((X, append))
 
         ws = window_size
@@ -241,42 +292,59 @@ class DataProcessor(object):
 
         valid = len(a) - ws
         nw = int(valid / ss)
-        out = np.ndarray((nw, ws), dtype=a.dtype)
-
-        for i in range(nw):
-            # "slide" the window along the samples
-            start = int(i * ss)
-            stop = int(start + ws)
-            out[i] = a[start: stop]
 
+        # "slide" the window along the samples without copying - windows
+        # share memory, so the view is read only
+        out = np.lib.stride_tricks.as_strided(a, shape=(nw, ws),
+                                              strides=(a.strides[0] * ss,
+                                                       a.strides[0]),
+                                              writeable=False)
         return out
 
-    def stft(self, X, fftsize=128, step=65, mean_normalize=True, real=False,
-             compute_onesided=True):
+    def hamming_window(self, size):
+        """
+        Hamming window of length `size`, cached per instance
+        Args:
+            size (int) : length of the window
+        Returns:
+            (np.array shape=(size,)) window coefficients
+        """
+        if size not in self._hamming_windows:
+            self._hamming_windows[size] = (0.54 - .46 * np.cos(
+                2 * np.pi * np.arange(size) / (size - 1))).astype(np.float32)
+        return self._hamming_windows[size]
+
+    def stft(self, X, fftsize=128, step=65, mean_normalize=True):
         """
-        Calculates short time Fourier transform for 1D real valued input X
+        Calculates the one sided short time Fourier transform
+        for 1D real valued input X
         Args:
             x (np.array) input data
         Returns:
-            (np.array) stFT transformed data
+            (np.array shape=(n_windows, fftsize // 2 + 1)) stFT transformed data
         """
-        if real:
-            local_fft = np.fft.rfft
-            cut = -1
-        else:
-            local_fft = np.fft.fft
-            cut = None
-        if compute_onesided:
-            cut = fftsize // 2
         if mean_normalize:
-            X -= X.mean()
+            # a new array rather than an in place update, so the caller's
+            # data is left untouched; overlap pads with zeros afterwards
+            X = X - X.mean()
 
         X = self.overlap(X, fftsize, step)
 
-        size = fftsize
-        win = 0.54 - .46 * np.cos(2 * np.pi * np.arange(size) / (size - 1))
-        X = X * win[None]
-        X = local_fft(X)[:, :cut]
+        # the strided frames are windowed into a scratch buffer kept
+        # across calls
+        dtype = np.result_type(X, np.float32)
+        buf = self._frames_buffer
+        if buf is None or len(buf) < len(X) or buf.shape[1] != fftsize \
+                or buf.dtype != dtype:
+            buf = self._frames_buffer = np.empty(X.shape, dtype=dtype)
+        buf = buf[:len(X)]
+
+        np.multiply(X, self.hamming_window(fftsize), out=buf)
+        # real input, so only the non-negative frequencies are computed;
+        # frames are transformed in parallel and the scratch buffer may be
+        # overwritten
+        X = rfft(buf, n=fftsize, axis=-1, workers=_FFT_WORKERS,
+                 overwrite_x=True)
         return X
 
     def pretty_spectrogram(self, data):
@@ -294,24 +362,71 @@ class DataProcessor(object):
         log = True
         thresh = self.spec_thresh
 
-        specgram = np.abs(self.stft(data, fftsize=fft_size,
-                          step=step_size, real=False, compute_onesided=True))
+        if log and self.device is not None:
+            return self._torch_pretty_spectrogram(data)
+
+        specgram = np.abs(self.stft(data, fftsize=fft_size, step=step_size))
 
         if log:
             specgram /= specgram.max()  # normalize to max 1
-            specgram = np.log10(specgram)
+            np.log10(specgram, out=specgram)
             # set anything less than the threshold as the threshold
-            specgram[specgram < -thresh] = -thresh
+            np.maximum(specgram, -thresh, out=specgram)
         else:
             # set anything less than the threshold as the threshold
-            specgram[specgram < thresh] = thresh
+            np.maximum(specgram, thresh, out=specgram)
 
         return specgram
 
+    def _torch_pretty_spectrogram(self, data):
+        """
+        Log spectrogram as in pretty_spectrogram, computed with torch on
+        self.device. Frames are batched through a single rfft call
+        Args:
+            data (np.array)
+        Returns:
+            (np.array) Spectrogram representation of audio
+        """
+        if torch is None:
+            raise ImportError('torch is required to compute spectrograms '
+                              'on {}'.format(self.device))
+        fft_size = self.fft_size
+        step_size = self.step_size
+
+        X = torch.from_numpy(np.asarray(data, dtype=np.float32)).to(self.device)
+        X = X - X.mean()
+        # pad and frame exactly as overlap does
+        X = torch.nn.functional.pad(X, (0, fft_size - len(X) % fft_size))
+        n_windows = (len(X) - fft_size) // step_size
+        X = X.unfold(0, fft_size, step_size)[:n_windows]
+
+        win = torch.from_numpy(self.hamming_window(fft_size)).to(self.device)
+        specgram = torch.fft.rfft(X * win).abs()
+        specgram /= specgram.max()  # normalize to max 1
+        # set anything less than the threshold as the threshold
+        specgram = torch.clamp(torch.log10(specgram), min=-self.spec_thresh)
+        return specgram.cpu().numpy()
+
     def make_mel(self, spectrogram, mel_filter, shorten_factor=1):
-        mel_spec = np.transpose(mel_filter).dot(np.transpose(spectrogram))
-        mel_spec = scipy.ndimage.zoom(mel_spec.astype('float32'),
-                                      [1, 1./shorten_factor]).astype('float64')
+        """
+        Projects a spectrogram onto the mel filterbank
+        Args:
+            spectrogram (np.array shape=(n_windows, n_bins))
+            mel_filter (np.array shape=(n_mel, n_bins)) : from create_mel_filter
+            shorten_factor (int) : compression factor on the x-axis (time)
+        Returns:
+            (np.array shape=(n_mel, n_windows // shorten_factor - 2)) mel spectrogram
+        """
+        # the filter is stored row major as (n_mel, n_bins) and the transposed
+        # spectrogram is a view, so this is a single gemm with no copies
+        mel_spec = mel_filter.dot(spectrogram.T)
+        k = int(shorten_factor)
+        if k > 1:
+            # compress the time axis by averaging each run of k frames,
+            # dropping any incomplete run at the end
+            n_frames = (mel_spec.shape[1] // k) * k
+            mel_spec = mel_spec[:, :n_frames].reshape(
+                mel_spec.shape[0], n_frames // k, k).mean(axis=2)
         mel_spec = mel_spec[:, 1:-1]
         return mel_spec
 
@@ -337,17 +452,23 @@ class DataProcessor(object):
         #  from Hz to fft bin number
         bin = np.floor((nfft+1)*self._mel_to_hz(melpoints)/samplerate)
 
-        fbank = np.zeros([nfilt, nfft//2])
-        for j in range(0, nfilt):
-            for i in range(int(bin[j]), int(bin[j+1])):
-                fbank[j, i] = (i - bin[j]) / (bin[j+1]-bin[j])
-            for i in range(int(bin[j+1]), int(bin[j+2])):
-                fbank[j, i] = (bin[j+2]-i) / (bin[j+2]-bin[j+1])
+        # build every triangular filter at once: row j rises over
+        # [bin[j], bin[j+1]) and falls over [bin[j+1], bin[j+2])
+        i = np.arange(nfft//2 + 1)[None, :]
+        lo, mid, hi = bin[:-2, None], bin[1:-1, None], bin[2:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            up = (i - lo) / (mid - lo)
+            down = (hi - i) / (hi - mid)
+        fbank = (np.where((i >= lo) & (i < mid), up, 0) +
+                 np.where((i >= mid) & (i < hi), down, 0))
         return fbank
 
     def create_mel_filter(self):
         """
         Creates a filter to convolve with the spectrogram to get out mels
+        Returns:
+            mel_filter (np.array shape=(n_mel, n_bins)) : normalised filterbank
+            mel_inversion_filter (np.array shape=(n_mel, n_bins)) : raw filterbank
         """
         mel_inversion_filter = self.get_filterbanks(nfilt=self.n_freq_components,
                                                     nfft=self.fft_size,
@@ -356,24 +477,50 @@ class DataProcessor(object):
                                                     highfreq=self.end_freq
                                                     )
         # Normalize
-        mel_filter = mel_inversion_filter.T / mel_inversion_filter.sum(axis=1)
-        return mel_filter, mel_inversion_filter
+        mel_filter = (mel_inversion_filter /
+                      mel_inversion_filter.sum(axis=1, keepdims=True))
+        return (mel_filter.astype(np.float32),
+                mel_inversion_filter.astype(np.float32))
+
+    @property
+    def mel_filters(self):
+        """(mel_filter, mel_inversion_filter) pair from create_mel_filter,
+        built on first access and reused afterwards
+        """
+        if self._mel_filters is None:
+            self._mel_filters = self.create_mel_filter()
+        return self._mel_filters
 
     @property
     def spectrogram(self):
-        """Generates training data in the form of spectrogram
+        """Generates training data in the form of spectrogram,
+        computed once per loaded sample
         """
-        return self.pretty_spectrogram(self.data.astype('float64'))
+        if self._spectrogram is None:
+            self._spectrogram = self.pretty_spectrogram(
+                self.data.astype(np.float32, copy=False))
+        return self._spectrogram
 
     @property
     def mel_spectrogram(self):
         """Generates training data in the form of mel spectrogram
         """
-        mel_filter, mel_inversion_filter = self.create_mel_filter()
+        mel_filter, mel_inversion_filter = self.mel_filters
         mel_spec = self.make_mel(self.spectrogram, mel_filter)
 
         return mel_spec
 
+    @property
+    def mel_spectrogram_q8(self):
+        """mel spectrogram quantised to uint8 for storage. Log values lie in
+        [-spec_thresh, 0] and map linearly onto 0-255, recover them with
+        q * spec_thresh / 255. - spec_thresh
+        """
+        scale = 255. / self.spec_thresh
+        mel_spec = (self.mel_spectrogram + self.spec_thresh) * scale
+        np.clip(np.round(mel_spec, out=mel_spec), 0, 255, out=mel_spec)
+        return mel_spec.astype(np.uint8)
+
     def save_images(self, path_to_save):
         """Save mel and spectrogram representations to file for debugging
         Args:
@@ -391,30 +538,55 @@ class DataProcessor(object):
         self.logger.info('saving imgs to: {}, {}'.format(spectrogram_path,
                                                          mel_spectrogram_path))
 
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(20, 4))
-        cax = ax.matshow(np.transpose(self.spectrogram),
-                         interpolation='nearest',
-                         aspect='auto',
-                         cmap=plt.cm.Greys,
-                         origin='lower'
-                         )
-        plt.title('Original Spectrogram')
-        plt.savefig(spectrogram_path)
-
-        plt.clf()
-
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(20, 4))
-        cax = ax.matshow(self.mel_spectrogram,
-                         interpolation='nearest',
-                         aspect='auto',
-                         cmap=plt.cm.Greys,
-                         origin='lower'
-                         )
-        plt.title('mel Spectrogram')
-        plt.savefig(mel_spectrogram_path)
+        # write the arrays straight to png, one pixel per bin/frame, rather
+        # than rendering a figure around them
+        plt.imsave(spectrogram_path, np.transpose(self.spectrogram),
+                   cmap=plt.cm.Greys, origin='lower')
+        plt.imsave(mel_spectrogram_path, self.mel_spectrogram,
+                   cmap=plt.cm.Greys, origin='lower')
 
         return spectrogram_path, mel_spectrogram_path
 
+    @classmethod
+    def process_batch(cls, filepaths, n_secs, max_workers=None, **kwargs):
+        """Loads a n_sec sample of each file and computes its spectrograms,
+        one file per worker process
+        Args:
+            filepaths (list of str) : the filepaths of the audio files (wav)
+            n_secs (float) : The number of seconds to sample from each file.
+            max_workers (int) : number of processes, defaults to cpu count
+            **kwargs : passed on to the DataProcessor constructor
+        Returns:
+            (list of tuple) (spectrogram, mel_spectrogram) per file, in order
+        """
+        # spawn rather than fork: a forked child inherits the parent's
+        # thread pools and any CUDA context, neither of which survive
+        # the fork. Callers need an `if __name__ == '__main__'` guard
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                 initializer=_init_worker) as executor:
+            return list(executor.map(_process_file, repeat(cls), filepaths,
+                                     repeat(n_secs), repeat(kwargs)))
+
+
+def _init_worker():
+    """process_batch worker initializer. Parallelism comes from the pool,
+    so each worker runs its fft and torch work on a single thread
+    rather than every worker starting one thread per core
+    """
+    global _FFT_WORKERS
+    _FFT_WORKERS = 1
+    if torch is not None:
+        torch.set_num_threads(1)
+
+
+def _process_file(cls, filepath, n_secs, kwargs):
+    """process_batch worker, module level so it can be pickled
+    """
+    dp = cls(filepath=filepath, **kwargs)
+    dp.load_data(n_secs=n_secs)
+    return dp.spectrogram, dp.mel_spectrogram
+
 
 #####################################
 #             TESTING               #